@@ -6,25 +6,210 @@
 
 from __future__ import annotations
 
-import argparse
-import atexit
 import enum
-import importlib
 import os
-import readline
 import sys
-import textwrap
 import typing as T
 
-import rich
+if T.TYPE_CHECKING:
+    import textwrap
 
 
+# Keep in sync with the argument parser built in main(). argparse renamed the
+# "optional arguments:" heading to "options:" in Python 3.10.
+_OPTIONS_HEADING = (
+    "options:" if sys.version_info >= (3, 10) else "optional arguments:"
+)
+_STATIC_HELP = f"""\
+usage: playbook [-h] [-L LOADPATH] PLAYBOOK
+
+Playbooks for semi-automated repetitive tasks.
+
+positional arguments:
+  PLAYBOOK     python expression evaluating to the class of the playbook to
+               run
+
+{_OPTIONS_HEADING}
+  -h, --help   show this help message and exit
+  -L LOADPATH  add LOADPATH to the python path for loading playbooks
+"""
+
 PLAYBOOK_HISTORY_PATH = os.path.expanduser("~/.playbook_history")
-if os.path.exists(PLAYBOOK_HISTORY_PATH):
-    readline.read_history_file(PLAYBOOK_HISTORY_PATH)
-readline.set_history_length(256)
-readline.parse_and_bind("tab: complete")
-atexit.register(readline.write_history_file, PLAYBOOK_HISTORY_PATH)
+PLAYBOOK_HISTORY_LENGTH = 256
+
+# History files larger than this are tail-read rather than loaded in full.
+_HISTORY_TAIL_THRESHOLD = 64 * 1024
+# Header line written by libedit at the start of its history files.
+_LIBEDIT_HISTORY_HEADER = b"_HiStOrY_V2_\n"
+
+
+def _history_tail(path: str, lines: int) -> bytes:
+    """Read the last few lines of the history file at path."""
+    with open(path, "rb") as history:
+        header = history.read(len(_LIBEDIT_HISTORY_HEADER))
+        pos = history.seek(0, os.SEEK_END)
+        tail = b""
+        # One extra newline is needed since the file ends with a newline.
+        while pos > 0 and tail.count(b"\n") <= lines:
+            step = min(pos, 4096)
+            pos -= step
+            history.seek(pos)
+            tail = history.read(step) + tail
+
+    if tail.count(b"\n") <= lines:
+        return tail
+    tail = b"\n".join(tail.split(b"\n")[-(lines + 1) :])
+    if header == _LIBEDIT_HISTORY_HEADER:
+        tail = header + tail
+    return tail
+
+
+def _read_history() -> None:
+    """Load at most PLAYBOOK_HISTORY_LENGTH entries from the history file."""
+    # pylint: disable=import-outside-toplevel
+    import readline
+    import tempfile
+
+    if os.path.getsize(PLAYBOOK_HISTORY_PATH) <= _HISTORY_TAIL_THRESHOLD:
+        readline.read_history_file(PLAYBOOK_HISTORY_PATH)
+        return
+
+    tail = _history_tail(PLAYBOOK_HISTORY_PATH, PLAYBOOK_HISTORY_LENGTH)
+    with tempfile.NamedTemporaryFile(prefix="playbook_history") as history:
+        history.write(tail)
+        history.flush()
+        readline.read_history_file(history.name)
+
+
+_history_initialized = False
+
+
+def _init_history() -> None:
+    """Load the readline history and arrange for it to be saved on exit.
+
+    Only the first call does anything, so this is safe to call from every
+    Playbook.run().
+    """
+    global _history_initialized  # pylint: disable=global-statement
+    if _history_initialized:
+        return
+    _history_initialized = True
+
+    # pylint: disable=import-outside-toplevel
+    import atexit
+    import readline
+
+    readline.set_history_length(PLAYBOOK_HISTORY_LENGTH)
+    if os.path.exists(PLAYBOOK_HISTORY_PATH):
+        _read_history()
+    readline.parse_and_bind("tab: complete")
+
+    initial_len = readline.get_current_history_length()
+    atexit.register(_save_history, initial_len)
+
+
+def _save_history(initial_len: int) -> None:
+    """Write the history entries added since startup to the history file."""
+    import readline  # pylint: disable=import-outside-toplevel
+
+    append_history_file = getattr(readline, "append_history_file", None)
+    if append_history_file is None or not os.path.exists(PLAYBOOK_HISTORY_PATH):
+        readline.write_history_file(PLAYBOOK_HISTORY_PATH)
+        return
+
+    # Appending also truncates the file to the configured history length, so
+    # the file cannot grow without bound.
+    new_entries = readline.get_current_history_length() - initial_len
+    if new_entries > 0:
+        append_history_file(new_entries, PLAYBOOK_HISTORY_PATH)
+
+
+def _wrap(wrapper: textwrap.TextWrapper, text: str) -> T.List[str]:
+    """Wrap text, skipping the wrapper for text that already fits on a line.
+
+    The shortcut is only taken for a plain TextWrapper whose options cannot
+    change text that fits; anything else always goes through wrapper.wrap().
+    """
+    import textwrap  # pylint: disable=import-outside-toplevel
+
+    # pylint: disable=unidiomatic-typecheck
+    if (
+        type(wrapper) is textwrap.TextWrapper
+        and not wrapper.fix_sentence_endings
+        and wrapper.drop_whitespace
+        and wrapper.expand_tabs
+        and text.isprintable()
+        and text.strip() == text
+        and text != ""
+        and len(wrapper.initial_indent) + len(text) <= wrapper.width
+    ):
+        return [wrapper.initial_indent + text]
+    return wrapper.wrap(text)
+
+
+def _split_doc(doc: T.Optional[str]) -> T.Tuple[str, ...]:
+    """Split a docstring into dedented paragraphs."""
+    if doc is None:
+        return ()
+
+    import textwrap  # pylint: disable=import-outside-toplevel
+
+    return tuple(textwrap.dedent(line) for line in doc.split("\n\n"))
+
+
+class _LazyTextWrapper:
+    """Class attribute holding a TextWrapper that is built on first access."""
+
+    def __init__(self, **kwargs: T.Any) -> None:
+        self._kwargs = kwargs
+        self._wrapper: T.Optional[textwrap.TextWrapper] = None
+
+    def __get__(
+        self, instance: T.Any, owner: T.Optional[type] = None
+    ) -> textwrap.TextWrapper:
+        if self._wrapper is None:
+            import textwrap  # pylint: disable=import-outside-toplevel
+
+            self._wrapper = textwrap.TextWrapper(**self._kwargs)
+        return self._wrapper
+
+
+def _rich_print(text: str) -> None:
+    """Print text containing rich markup."""
+    import rich  # pylint: disable=import-outside-toplevel
+
+    rich.print(text)
+
+
+def _select_output() -> T.Callable[[str], None]:
+    """Pick how playbooks print, avoiding rich when stdout is not a tty."""
+    if sys.stdout.isatty():
+        import rich  # pylint: disable=import-outside-toplevel
+
+        return rich.print
+
+    import re  # pylint: disable=import-outside-toplevel
+
+    # Same tag grammar as rich.markup: an optional run of backslashes followed
+    # by a [tag], where the tag starts with a letter, "#", "/" or "@".
+    markup = re.compile(r"(\\*)\[([a-z#/@][^[]*?)]")
+
+    def strip_tag(match: re.Match[str]) -> str:
+        backslashes, escaped = divmod(len(match.group(1)), 2)
+        if escaped:
+            # An escaped tag is printed literally, minus the escape.
+            return "\\" * backslashes + f"[{match.group(2)}]"
+        return "\\" * backslashes
+
+    def plain_print(text: str) -> None:
+        print(markup.sub(strip_tag, text))
+
+    return plain_print
+
+
+# Output function for messages containing rich markup; main() replaces it with
+# one suited to stdout.
+_output: T.Callable[[str], None] = _rich_print
 
 
 class Transition(enum.Enum):
@@ -38,36 +223,70 @@ class Transition(enum.Enum):
 class Playbook:
     """A single repetitive task that must be accomplished."""
 
-    title_wrapper = textwrap.TextWrapper(
+    title_wrapper = _LazyTextWrapper(
         initial_indent="[green]│[/green] ", subsequent_indent="  "
     )
-    body_wrapper = textwrap.TextWrapper(
-        initial_indent="  ", subsequent_indent="  "
-    )
+    body_wrapper = _LazyTextWrapper(initial_indent="  ", subsequent_indent="  ")
+
+    _wrapped_doc_cache: T.Tuple[T.Tuple[T.Any, ...], str]
+    # The docstring these paragraphs were split from, and the paragraphs.
+    _doc_paragraphs: T.Tuple[T.Optional[str], T.Tuple[str, ...]] = (None, ())
+
+    def __init_subclass__(cls, **kwargs: T.Any) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._doc_paragraphs = (cls.__doc__, _split_doc(cls.__doc__))
 
     def do_run(self) -> Transition:
         """Run this playbook."""
         raise NotImplementedError()
 
-    def _print_docstring(self) -> None:
-        if self.__doc__ is None:
-            return
+    @classmethod
+    def _wrapped_doc(cls) -> T.Optional[str]:
+        """Format the docstring of this playbook for printing.
+
+        The result is cached on the class and rebuilt whenever the docstring or
+        either wrapper is replaced. The docstring and wrappers are read from the
+        class, so wrappers must be set on the class rather than on an instance.
+        """
+        if cls.__doc__ is None:
+            return None
 
-        paragraphs = [
-            textwrap.dedent(line) for line in self.__doc__.split("\n\n")
-        ]
-        title = "\n".join(self.title_wrapper.wrap(paragraphs[0]))
+        title_wrapper = cls.title_wrapper
+        body_wrapper = cls.body_wrapper
+        key = (cls.__doc__, title_wrapper, body_wrapper)
+        cached = cls.__dict__.get("_wrapped_doc_cache")
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        doc_source, paragraphs = cls._doc_paragraphs
+        if doc_source is not cls.__doc__:
+            # The docstring was replaced after the class was created.
+            paragraphs = _split_doc(cls.__doc__)
+            cls._doc_paragraphs = (cls.__doc__, paragraphs)
+
+        title = "\n".join(_wrap(title_wrapper, paragraphs[0]))
         body = "\n\n".join(
-            "\n".join(self.body_wrapper.wrap(paragraph))
+            "\n".join(_wrap(body_wrapper, paragraph))
             for paragraph in paragraphs[1:]
         )
-        rich.print(f"[green]┌───────────────[/green]\n{title}\n")
+        doc = f"[green]┌───────────────[/green]\n{title}\n"
         if body:
-            rich.print(f"\n{body}\n")
+            doc += f"\n\n{body}\n"
+
+        cls._wrapped_doc_cache = (key, doc)
+        return doc
+
+    def _print_docstring(self) -> None:
+        doc = self._wrapped_doc()
+        if doc is None:
+            return
+
+        _output(doc)
 
     def _maybe_run_method(self, method_name: str) -> None:
-        if hasattr(self, method_name) and callable(getattr(self, method_name)):
-            getattr(self, method_name)()
+        method = getattr(self, method_name, None)
+        if callable(method):
+            method()
 
     def prepare(self) -> None:
         """Prepare to run a playbook."""
@@ -75,21 +294,23 @@ class Playbook:
 
     def run(self) -> None:
         """Run a playbook."""
-        self.prepare()
+        _init_history()
+
+        while True:
+            self.prepare()
+
+            self._print_docstring()
 
-        self._print_docstring()
+            result = self.do_run()
+            if result == Transition.CONTINUE:
+                break
+            if result == Transition.RETRY:
+                _output(f"re-trying {self.__class__.__name__}...")
+                self.cleanup()
+                continue
 
-        result = self.do_run()
-        if result == Transition.CONTINUE:
-            pass
-        elif result == Transition.RETRY:
-            rich.print(f"re-trying {self.__class__.__name__}...")
-            self.run()
-        else:
             # the playbook either returned HALT or some unknown value
-            rich.print(
-                f"cannot continue after {self.__class__.__name__}; exiting"
-            )
+            _output(f"cannot continue after {self.__class__.__name__}; exiting")
             sys.exit(1)
 
         self.cleanup()
@@ -100,7 +321,12 @@ class Playbook:
 
     @classmethod
     def serial(cls, playbooks: T.List[Playbook]) -> T.Type[Playbook]:
-        """Build a new playbook that runs the specified playbooks in series."""
+        """Build a new playbook that runs the specified playbooks in series.
+
+        A new class is built on every call. Callers instantiate the result or
+        subclass it to give the serial playbook a docstring, so the playbooks
+        for each call have to live on their own class.
+        """
 
         class SerialPlaybook(Playbook):
             # pylint: disable=missing-class-docstring
@@ -114,6 +340,12 @@ class Playbook:
 
 def main() -> None:
     """Load and run a playbook."""
+    if len(sys.argv) == 1 or sys.argv[1] in ("-h", "--help"):
+        sys.stdout.write(_STATIC_HELP)
+        return
+
+    import argparse  # pylint: disable=import-outside-toplevel
+
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
         "-L",
@@ -127,15 +359,29 @@ def main() -> None:
         help="python expression evaluating to the class of the playbook to run",
     )
     args = parser.parse_args()
+
+    import importlib  # pylint: disable=import-outside-toplevel
+
+    global _output  # pylint: disable=global-statement
+    _output = _select_output()
+
     sys.path.append(args.L)
 
     (module, _, cls) = args.PLAYBOOK.rpartition(".")
-    playbook = importlib.import_module(module).__dict__.get(cls, object)
-    if not issubclass(playbook, Playbook):
-        rich.print(
+    if module == "":
+        _output(
+            f"The expression {args.PLAYBOOK} must be of the form MODULE.CLASS."
+        )
+        _output("Cannot continue; exiting.")
+        sys.exit(1)
+
+    mod = sys.modules.get(module) or importlib.import_module(module)
+    playbook = getattr(mod, cls, None)
+    if not (isinstance(playbook, type) and issubclass(playbook, Playbook)):
+        _output(
             f"The expression {args.PLAYBOOK} doesn't evaluate to a playbook."
         )
-        rich.print("Cannot continue; exiting.")
+        _output("Cannot continue; exiting.")
         sys.exit(1)
 
     playbook().run()
@@ -4,8 +4,8 @@
 
 """Various pre-set tasks for a playbook."""
 
-import dataclasses
 import glob
+import itertools
 import os
 import pathlib
 import readline
@@ -13,22 +13,40 @@ import typing as T
 
 from playbook import Playbook, Transition
 
+CONTINUE, RETRY, HALT = Transition.CONTINUE, Transition.RETRY, Transition.HALT
+
+# Maximum number of paths offered when tab-completing a path.
+_MAX_PATH_COMPLETIONS = 256
+
+# Only break completions on tabs and newlines so paths may contain spaces.
+_PATH_DELIMS = "\t\n"
+
+_HOME = os.path.expanduser("~")
+_HOME_SLASH = _HOME + "/"
+_HOME_SLASH_LEN = len(_HOME_SLASH)
+
+
+_YN = ("y", "n")
+_YN_SET = frozenset(_YN)
+
 
 def _complete_yn(text: str, state: int) -> T.Optional[str]:
     """Completion function for completing y|n."""
-    responses = ["y", "n"]
-    if text == "" and state < len(responses):
-        return responses[state]
-    if text in responses and state == 0:
+    if not text:
+        return _YN[state] if state < len(_YN) else None
+    if state == 0 and text in _YN_SET:
         return text
     return None
 
 
-@dataclasses.dataclass
 class AcceptUserInput(Playbook):
     """Please enter the required information to proceed."""
 
-    prompt: str = "> "
+    prompt = "> "
+
+    def __init__(self, prompt: T.Optional[str] = None) -> None:
+        if prompt is not None:
+            self.prompt = prompt
 
     def do_run(self) -> Transition:
         """Prompt the user for input before continuing.
@@ -43,7 +61,7 @@ class AcceptUserInput(Playbook):
             response = input(self.prompt)
         except EOFError:
             print("\n\nno input provided")
-            return Transition.HALT
+            return HALT
         return self.accept(response)
 
     def accept(self, response: str) -> Transition:
@@ -51,24 +69,35 @@ class AcceptUserInput(Playbook):
         raise NotImplementedError()
 
 
-@dataclasses.dataclass
 class WaitToProceed(AcceptUserInput):
     """Pausing until you wish to continue."""
 
-    prompt: str = "continue? (y|n) "
+    prompt = "continue? (y|n) "
 
     @classmethod
     def do_prepare(cls) -> None:
         """Set up tab completion to prepare for running."""
         readline.set_completer(_complete_yn)
 
+    def do_run(self) -> Transition:
+        """Prompt until the user answers y or n.
+
+        Invalid answers are re-prompted here rather than retrying the whole
+        playbook, so the docstring is not printed again.
+        """
+        while True:
+            result = super().do_run()
+            if result != RETRY:
+                return result
+            print("please answer y or n")
+
     def accept(self, response: str) -> Transition:
         """Prompt the user to continue."""
         if response == "y":
-            return Transition.CONTINUE
+            return CONTINUE
         if response == "n":
-            return Transition.HALT
-        return Transition.RETRY
+            return HALT
+        return RETRY
 
     @classmethod
     def do_cleanup(cls) -> None:
@@ -76,12 +105,9 @@ class WaitToProceed(AcceptUserInput):
         readline.set_completer(None)
 
 
-@dataclasses.dataclass
 class AcceptPathInput(AcceptUserInput):
     """Please enter a valid path."""
 
-    prompt: str = "> "
-
     last_glob: T.Optional[str] = None
     cached_expansion: T.Optional[T.List[str]] = None
 
@@ -91,13 +117,17 @@ class AcceptPathInput(AcceptUserInput):
     def _complete_path(self, text: str, state: int) -> T.Optional[str]:
         """Completion function for completing paths using globs."""
         if text != self.last_glob:
-            expansion = glob.glob(os.path.expanduser(text) + "*")
+            expanded = os.path.expanduser(text)
+            expansion = list(
+                itertools.islice(
+                    glob.iglob(expanded + "*"), _MAX_PATH_COMPLETIONS
+                )
+            )
             # Did we do $HOME expansion?
-            if len(expansion) > 0 and not expansion[0].startswith(text):
+            if expanded != text and expanded.startswith(_HOME_SLASH):
                 # If so, replace $HOME with ~/ so that expansions match the text
                 # already input by the user.
-                home = os.path.expanduser("~/")
-                expansion = ["~/" + s.removeprefix(home) for s in expansion]
+                expansion = ["~/" + s[_HOME_SLASH_LEN:] for s in expansion]
             self.cached_expansion = expansion
             self.last_glob = text
 
@@ -109,8 +139,10 @@ class AcceptPathInput(AcceptUserInput):
 
     def do_prepare(self) -> None:
         """Set up tab completion for completing paths."""
-        self.old_delims = readline.get_completer_delims()
-        readline.set_completer_delims("\t\n")
+        delims = readline.get_completer_delims()
+        if delims != _PATH_DELIMS:
+            self.old_delims = delims
+            readline.set_completer_delims(_PATH_DELIMS)
         readline.set_completer(self._complete_path)
 
     def accept(self, response: str) -> Transition:
@@ -126,6 +158,7 @@ class AcceptPathInput(AcceptUserInput):
 
     def do_cleanup(self) -> None:
         """Remove path tab completion."""
-        assert self.old_delims is not None
-        readline.set_completer_delims(self.old_delims)
+        if self.old_delims is not None:
+            readline.set_completer_delims(self.old_delims)
+            self.old_delims = None
         readline.set_completer(None)